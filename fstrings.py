@@ -6,17 +6,52 @@
 >>> o = ast.parse(s)
 >>> v = Visitor()
 >>> v.visit(o)
+>>> print(v.getvalue(), end='')
 def say(greeting='hello', target='world'):
     print(f'{greeting[0].upper()}{greeting[1:]}, {target}!')
+
+Arguments without a default keep their place before defaulted ones:
+
+>>> v = Visitor()
+>>> v.visit(ast.parse('def f(a, b, c=3):\\n    return a\\n'))
+>>> print(v.getvalue(), end='')
+def f(a, b, c=3):
+    return a
+
+Braces in the format string are escaped in the f-string:
+
+>>> v = Visitor()
+>>> v.visit(ast.parse("x = '{%s}' % y\\n"))
+>>> print(v.getvalue(), end='')
+x = f'{{{y}}}'
+
+A format string with more conversions than arguments is left alone:
+
+>>> v = Visitor()
+>>> v.visit(ast.parse("x = '%s %s' % (a,)\\n"))
+>>> print(v.getvalue(), end='')
+x = '%s %s' % (a,)
+
+Setting first_line and last_line restricts the output to those lines:
+
+>>> v = Visitor()
+>>> v.first_line, v.last_line = 2, 3
+>>> v.visit(ast.parse('a = 1\\nb = 2\\nc = 3\\nd = 4\\n'))
+>>> print(v.getvalue(), end='')
+b = 2
+c = 3
 """
 
 import re
+import functools
 import ast
 import sys
-import contextlib
+from typing import (
+    Any, Callable, ClassVar, Dict, List, Optional, Sequence, TextIO, Tuple,
+    Union)
 
 
-PRECEDENCE = [
+PRECEDENCE: List[List[type]] = [
     [ast.Lambda],
     [ast.IfExp],
     [ast.Or],
@@ -37,104 +72,325 @@ PRECEDENCE = [
     [ast.Tuple, ast.List, ast.Dict, ast.Set],
 ]
 
+_PREC = {cls: i for i, row in enumerate(PRECEDENCE) for cls in row}
+
+
+_BINOP_SYM = {
+    ast.Mod: '%',
+    ast.Sub: '-',
+    ast.Add: '+',
+    ast.Mult: '*',
+    ast.Pow: '**',
+    ast.Div: '/',
+    ast.FloorDiv: '//',
+}
+
+_UNARYOP_SYM = {
+    ast.USub: '-',
+    ast.UAdd: '+',
+}
+
+_CMPOP_SYM = {
+    ast.Lt: '<',
+    ast.Gt: '>',
+    ast.LtE: '<=',
+    ast.GtE: '>=',
+    ast.Eq: '==',
+    ast.NotEq: '!=',
+    ast.In: ' in ',
+    ast.Is: ' is ',
+    ast.IsNot: ' is not ',
+}
+
+_BOOLOP_SYM = {
+    ast.And: ' and ',
+    ast.Or: ' or ',
+}
+
+# Operators as written between two operands.
+_BINOP_PADDED = {op: ' %s ' % sym for op, sym in _BINOP_SYM.items()}
+_CMPOP_PADDED = {op: ' %s ' % sym for op, sym in _CMPOP_SYM.items()}
+
+
+_TYPE_NAME_CACHE: Dict[type, str] = {}
+
+_NEWLINES = tuple('\n' * i for i in range(256))
+_SPACES = tuple(' ' * i for i in range(256))
+
+# Escapes for printable text in a single-quoted string; anything else
+# goes through repr(). Literal text in an f-string also doubles braces.
+_ESCAPES = str.maketrans({'\\': '\\\\', "'": "\\'"})
+_BRACES = str.maketrans({'{': '{{', '}': '}}'})
+
+
+_PRINTF_RE = re.compile(
+    r'%(?P<key>\([^)]*\))?'
+    r'(?P<flag>[#0 +-]*)'
+    r'(?P<widthprec>(?P<width>\*|\d+)?'
+    r'(?:\.(?P<prec>\*|\d+))?)'
+    r'(?P<length>[hlL])?'
+    r'(?P<type>.)',
+    re.ASCII)
+
+
+_Part = Union[str, Tuple[int, str]]
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_format(s: str) -> Optional[Tuple[Tuple[_Part, ...], int]]:
+    # Split s into literal parts and (argument index, format spec) pairs,
+    # and count the arguments consumed. None if s uses a conversion with
+    # no f-string equivalent.
+    res: List[_Part] = []
+    i = 0
+    k = 0
+    for mo in _PRINTF_RE.finditer(s):
+        j = mo.start(0)
+        res.append(s[i:j])
+        i = mo.end(0)
+        t = mo.group('type')
+        if t == '%':
+            res.append('%')
+            continue
+        elif t == 's':
+            spec = ''
+        elif t == 'r':
+            spec = '!r'
+        elif t in ('d', 'e', 'f', 'g'):
+            spec = ':' + mo.group('widthprec') + t
+        else:
+            return None
+        res.append((k, spec))
+        k += 1
+    res.append(s[i:])
+    return tuple(res), k
+
+
+# String literals parse as ast.Constant since Python 3.8; the ast.Str
+# alias is deprecated there and removed in 3.14.
+_STR_NODE = ast.Constant if sys.version_info >= (3, 8) else ast.Str
 
-def precedence(op):
-    for i in range(len(PRECEDENCE)):
-        if op in PRECEDENCE[i]:
-            return i
+
+def _string_literal(node: ast.expr) -> Optional[str]:
+    if isinstance(node, ast.Constant):
+        return node.value if isinstance(node.value, str) else None
+    if sys.version_info < (3, 8) and isinstance(node, ast.Str):
+        return node.s
+    return None
+
+
+def precedence(op: type) -> int:
+    return _PREC.get(op, -1)
 
 
 class Visitor(ast.NodeVisitor):
-    def __init__(self):
-        self.output_line = 1
-        self.output_col = 0
-        self.first_line = 0
-        self.last_line = float('inf')
-        self.p_level = 0
-        self.precedence = [-1]
-
-    def print(self, s, l, c):
+    # Unbound visit_* functions by node type, shared by all instances.
+    _handlers: ClassVar[Dict[type, Callable]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._handlers = cls._build_handlers()
+
+    @classmethod
+    def _build_handlers(cls):
+        # vars() rather than getattr() so that the deprecated aliases
+        # (ast.Str, ast.Num, ...) are not looked up on Python 3.12+, where
+        # they only exist through a warning module __getattr__.
+        node_types = vars(ast)
+        handlers = {}
+        for name in dir(cls):
+            if name.startswith('visit_'):
+                t = node_types.get(name[len('visit_'):])
+                if isinstance(t, type) and issubclass(t, ast.AST):
+                    handlers[t] = getattr(cls, name)
+        return handlers
+
+    def __init__(self) -> None:
+        self.output_line: int = 1
+        self.output_col: int = 0
+        self.first_line: int = 0
+        self.last_line: int = sys.maxsize
+        self.p_level: int = 0
+        self.precedence: List[int] = [-1]
+        self._buf: Optional[List[str]] = None
+        # Cleared capture buffers, reused by _render_to_string().
+        self._buf_pool: List[List[str]] = []
+        self._out: List[str] = []
+        # Pending statements, and (function, *args) tuples to call once
+        # the statements pushed before them are done. See _visit_body().
+        self._stack: List[Any] = []
+        self._draining: bool = False
+        # Source text for source_backtrace(), split into lines on demand.
+        self._source: str = ''
+        self._source_lines: Optional[List[str]] = None
+
+    def print(self, s: str, l: int, c: int) -> None:
+        if self._buf is not None:
+            self._buf.append(s)
+            return
+        pre = ''
         if self.output_line < l:
-            self.write('\n' * (l - self.output_line))
-        if self.output_col < c:
-            self.write(' ' * (c - self.output_col))
-        self.write(s)
+            n = l - self.output_line
+            pre = _NEWLINES[n] if n < len(_NEWLINES) else '\n' * n
+            # the newlines reset the column
+            col = 0
+        else:
+            col = self.output_col
+        if col < c:
+            m = c - col
+            pre += _SPACES[m] if m < len(_SPACES) else ' ' * m
+        self.write(pre + s if pre else s)
 
-    def print_before(self, s, l, c):
+    def print_before(self, s: str, l: int, c: int) -> None:
         self.print(s, l, max(0, c - len(s)))
 
-    def write(self, s):
-        lines = s.splitlines(True)
-        for line in lines:
+    def write(self, s: str) -> None:
+        if self._buf is not None:
+            self._buf.append(s)
+            return
+        if '\n' not in s:
             if self.first_line <= self.output_line <= self.last_line:
-                sys.stdout.write(line)
-            if line.endswith('\n'):
-                self.output_line += 1
-                self.output_col = 0
-            else:
-                self.output_col += len(line)
-
-    def visit(self, node):
+                self._out.append(s)
+            self.output_col += len(s)
+            return
+        nl = s.count('\n')
+        if (self.first_line <= self.output_line and
+                self.output_line + nl <= self.last_line):
+            self._out.append(s)
+        elif (self.output_line <= self.last_line and
+                self.output_line + nl >= self.first_line):
+            # s straddles the first_line/last_line boundary
+            for i, line in enumerate(s.split('\n')):
+                if self.first_line <= self.output_line + i <= self.last_line:
+                    self._out.append(line if i == nl else line + '\n')
+        self.output_line += nl
+        self.output_col = len(s) - s.rfind('\n') - 1
+
+    def getvalue(self) -> str:
+        return ''.join(self._out)
+
+    def visit(self, node: ast.AST) -> Any:
         try:
-            return super(Visitor, self).visit(node)
+            h = self._handlers.get(type(node))
+            if h is None:
+                return self.generic_visit(node)
+            return h(self, node)
         except Exception:
             self.source_backtrace(node, sys.stderr)
             raise
 
-    def source_backtrace(self, node, file):
+    def _visit_body(self, body: Sequence[ast.AST],
+                    then: Sequence[Any] = ()) -> None:
+        # Statements are queued on self._stack rather than visited
+        # recursively, so nesting depth does not grow the Python stack.
+        # Items in `then` run after body, in order.
+        #
+        # While draining, this only queues the body and returns: any code
+        # the calling handler runs after _visit_body() executes *before*
+        # the body is visited. Anything that must be emitted after the
+        # body has to go in `then`, as a (function, *args) tuple.
+        stack = self._stack
+        stack.extend(reversed(then))
+        stack.extend(reversed(body))
+        if not self._draining:
+            self._drain()
+
+    def _drain(self) -> None:
+        stack = self._stack
+        handlers = self._handlers
+        generic_visit = type(self).generic_visit
+        # Statements whose queued body is still being visited, innermost
+        # last, for source_backtrace(). A None on the stack marks where
+        # the innermost one's queued items end.
+        enclosing: List[ast.AST] = []
+        self._draining = True
+        try:
+            while stack:
+                item = stack.pop()
+                if item is None:
+                    enclosing.pop()
+                elif type(item) is tuple:
+                    item[0](*item[1:])
+                else:
+                    n = len(stack)
+                    enclosing.append(item)
+                    handlers.get(type(item), generic_visit)(self, item)
+                    if len(stack) > n:
+                        stack.insert(n, None)
+                    else:
+                        enclosing.pop()
+        except Exception:
+            for node in reversed(enclosing):
+                self.source_backtrace(node, sys.stderr)
+            raise
+        finally:
+            self._draining = False
+            stack.clear()
+
+    def _print_clause(self, s: str, col: int) -> None:
+        self.print(s, self.output_line + 1, col)
+
+    def source_backtrace(self, node: Any, file: TextIO) -> None:
         try:
             lineno = node.lineno
             col_offset = node.col_offset
         except AttributeError:
             lineno = col_offset = None
         print('At node %s' % node, file=file)
-        if lineno is not None and lineno > 0:
+        if self._source_lines is None:
+            self._source_lines = self._source.splitlines()
+        if lineno is not None and 0 < lineno <= len(self._source_lines):
             print(self._source_lines[lineno - 1], file=file)
             print(' ' * col_offset + '^', file=file)
 
-    def generic_visit(self, node):
-        self.print(str(node), getattr(node, 'lineno', 0), getattr(node, 'col_offset', 0))
+    def generic_visit(self, node: ast.AST) -> None:
+        t = type(node)
+        name = _TYPE_NAME_CACHE.get(t)
+        if name is None:
+            name = _TYPE_NAME_CACHE[t] = '<%s>' % t.__name__
+        self.print(name, getattr(node, 'lineno', 0),
+                   getattr(node, 'col_offset', 0))
 
-    def visit_Module(self, node):
-        for child in node.body:
-            self.visit(child)
+    def visit_Module(self, node: ast.Module) -> None:
+        self._visit_body(node.body)
 
-    def visit_Import(self, node):
+    def visit_Import(self, node: ast.Import) -> None:
         self.print('import ', node.lineno, node.col_offset)
-        for i, n in enumerate(node.names):
-            if i:
-                self.write(', ')
-            self.write(n.name)
-            if n.asname:
-                self.write(' as ')
-                self.write(n.asname)
+        names = iter(node.names)
+        self.visit_alias(next(names))
+        for n in names:
+            self.write(', ')
+            self.visit_alias(n)
+
+    def visit_alias(self, node: ast.alias) -> None:
+        self.write(node.name)
+        if node.asname:
+            self.write(' as ')
+            self.write(node.asname)
 
-    def visit_FunctionDef(self, node):
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> None:
         self.print('def ', node.lineno, node.col_offset)
         self.write(node.name)
         self.write('(')
         self.visit_arguments(node.args)
         self.write('):')
-        for child in node.body:
-            self.visit(child)
+        self._visit_body(node.body)
 
-    def visit_ClassDef(self, node):
+    def visit_ClassDef(self, node: ast.ClassDef) -> None:
         self.print('class ', node.lineno, node.col_offset)
         self.write(node.name)
         self.write('(')
         self.visit_commasep(node.bases)
         self.write('):')
-        for child in node.body:
-            self.visit(child)
+        self._visit_body(node.body)
 
-    def visit_While(self, node):
+    def visit_While(self, node: ast.While) -> None:
         self.print('while ', node.lineno, node.col_offset)
         self.visit(node.test)
         self.write(':')
-        for child in node.body:
-            self.visit(child)
+        self._visit_body(node.body)
 
-    def visit_With(self, node):
+    def visit_With(self, node: ast.With) -> None:
         self.print('with ', node.lineno, node.col_offset)
         for v in node.items:
             self.visit(v.context_expr)
@@ -142,97 +398,100 @@ class Visitor(ast.NodeVisitor):
                 self.write(' as ')
                 self.visit(v.optional_vars)
         self.write(':')
-        for child in node.body:
-            self.visit(child)
+        self._visit_body(node.body)
+
+    def visit_If(self, node: ast.If) -> None:
+        self._visit_if_clause(node, 'if', node.col_offset)
 
-    def visit_If(self, node, keyword='if', col=None):
-        if col is None:
-            col = node.col_offset
+    def _visit_if_clause(self, node: ast.If, keyword: str, col: int) -> None:
         self.print(keyword + ' ', node.lineno, col)
         self.visit(node.test)
         self.write(':')
-        for child in node.body:
-            self.visit(child)
-        if len(node.orelse) > 0:
-            if (len(node.orelse) == 1 and
-                    isinstance(node.orelse[0], ast.If)):
-                self.visit_If(node.orelse[0], 'elif', col)
-            else:
-                self.print('else:', self.output_line + 1, col)
-                for tail in node.orelse:
-                    self.visit(tail)
+        self._visit_body(node.body, [(self._visit_if_orelse, node, col)])
 
-    def visit_Try(self, node):
+    def _visit_if_orelse(self, node: ast.If, col: int) -> None:
+        orelse = node.orelse
+        if len(orelse) == 1 and isinstance(orelse[0], ast.If):
+            self._visit_if_clause(orelse[0], 'elif', col)
+        elif orelse:
+            self._print_clause('else:', col)
+            self._visit_body(orelse)
+
+    def visit_Try(self, node: ast.Try) -> None:
         self.print('try:', node.lineno, node.col_offset)
-        for child in node.body:
-            self.visit(child)
-        for excepthandler in node.handlers:
-            self.print('except',
-                       excepthandler.lineno, excepthandler.col_offset)
-            if excepthandler.type:
-                self.visit(excepthandler.type)
-            if excepthandler.name:
-                self.write(' as ')
-                self.write(excepthandler.name)
-            self.write(':')
-            for child in excepthandler.body:
-                self.visit(child)
+        then: List[Any] = list(node.handlers)
         if node.orelse:
-            self.print('else:', self.output_line + 1, node.col_offset)
-            for tail in node.orelse:
-                self.visit(tail)
+            then.append((self._print_clause, 'else:', node.col_offset))
+            then.extend(node.orelse)
         if node.finalbody:
-            self.print('finally:', self.output_line + 1, node.col_offset)
-            for tail in node.finalbody:
-                self.visit(tail)
+            then.append((self._print_clause, 'finally:', node.col_offset))
+            then.extend(node.finalbody)
+        self._visit_body(node.body, then)
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler) -> None:
+        self.print('except', node.lineno, node.col_offset)
+        if node.type:
+            self.visit(node.type)
+        if node.name:
+            self.write(' as ')
+            self.write(node.name)
+        self.write(':')
+        self._visit_body(node.body)
 
-    def visit_For(self, node):
+    def visit_For(self, node: ast.For) -> None:
         self.print('for ', node.lineno, node.col_offset)
         self.visit(node.target)
         self.write(' in ')
         self.visit(node.iter)
         self.write(':')
-        for child in node.body:
-            self.visit(child)
+        self._visit_body(node.body)
 
-    def visit_arguments(self, args):
-        for i, (a, d) in enumerate(zip(args.args, args.defaults)):
+    def visit_arguments(self, args: ast.arguments) -> None:
+        defaults = args.defaults
+        offset = len(args.args) - len(defaults)
+        for i, a in enumerate(args.args):
             if i:
                 self.write(',')
             self.print(a.arg, a.lineno, a.col_offset)
-            if d is not None:
+            if i >= offset:
                 self.write('=')
-                self.visit(d)
-
-    def visit_commasep(self, elts):
-        for i, arg in enumerate(elts):
-            if i:
-                self.write(',')
-            self.visit(arg)
+                self.visit(defaults[i - offset])
 
-    def visit_Break(self, node):
+    def visit_commasep(self, elts: Sequence[ast.AST]) -> None:
+        it = iter(elts)
+        first = next(it, None)
+        if first is None:
+            return
+        visit = self.visit
+        write = self.write
+        visit(first)
+        for arg in it:
+            write(',')
+            visit(arg)
+
+    def visit_Break(self, node: ast.Break) -> None:
         self.print('break', node.lineno, node.col_offset)
 
-    def visit_Continue(self, node):
+    def visit_Continue(self, node: ast.Continue) -> None:
         self.print('continue', node.lineno, node.col_offset)
 
-    def visit_Pass(self, node):
+    def visit_Pass(self, node: ast.Pass) -> None:
         self.print('pass', node.lineno, node.col_offset)
 
-    def visit_Expr(self, node):
+    def visit_Expr(self, node: ast.Expr) -> None:
         self.visit(node.value)
 
-    def visit_Return(self, node):
+    def visit_Return(self, node: ast.Return) -> None:
         self.print('return', node.lineno, node.col_offset)
         if node.value:
             self.visit(node.value)
 
-    def visit_Yield(self, node):
+    def visit_Yield(self, node: ast.Yield) -> None:
         self.print('yield', node.lineno, node.col_offset)
         if node.value:
             self.visit(node.value)
 
-    def visit_Raise(self, node):
+    def visit_Raise(self, node: ast.Raise) -> None:
         self.print('raise', node.lineno, node.col_offset)
         if node.exc:
             self.visit(node.exc)
@@ -240,7 +499,7 @@ class Visitor(ast.NodeVisitor):
             self.write(' from')
             self.visit(node.cause)
 
-    def visit_Assign(self, node):
+    def visit_Assign(self, node: ast.Assign) -> None:
         for t in node.targets:
             if isinstance(t, ast.Tuple):
                 t.col_offset = node.col_offset + 1  # for Tuple
@@ -248,203 +507,144 @@ class Visitor(ast.NodeVisitor):
             self.write(' = ')
         self.visit(node.value)
 
-    def visit_AugAssign(self, node):
-        ops = {
-            ast.Mod: '%',
-            ast.Sub: '-',
-            ast.Add: '+',
-            ast.Mult: '*',
-            ast.Pow: '**',
-            ast.Div: '/',
-            ast.FloorDiv: '//',
-        }
+    def visit_AugAssign(self, node: ast.AugAssign) -> None:
         if isinstance(node.target, ast.Tuple):
             node.target.col_offset = node.col_offset + 1  # for Tuple
         self.visit(node.target)
         self.write(' ')
-        self.write(ops.get(type(node.op), str(node.op)))
+        self.write(_BINOP_SYM.get(type(node.op), str(node.op)))
         self.write('=')
         self.write(' ')
         self.visit(node.value)
 
-    def visit_Call(self, node):
+    def visit_Call(self, node: ast.Call) -> None:
         self.visit(node.func)
         self.write('(')
         self.visit_commasep(node.args)
-        for j, kw in enumerate(node.keywords):
-            k = kw.arg
-            v = kw.value
-            if j or node.args:
-                self.write(',')
-            if k is None:
-                self.print_before('**', v.lineno, v.col_offset)
-            else:
-                self.print_before(k + '=', v.lineno, v.col_offset)
-            self.visit(v)
-
+        if node.args and node.keywords:
+            self.write(',')
+        self.visit_commasep(node.keywords)
         self.write(')')
 
-    @contextlib.contextmanager
-    def auto_parens(self, node, op, left, right):
+    def visit_keyword(self, node: ast.keyword) -> None:
+        v = node.value
+        if node.arg is None:
+            self.print_before('**', v.lineno, v.col_offset)
+        else:
+            self.print_before(node.arg + '=', v.lineno, v.col_offset)
+        self.visit(v)
+
+    def _enter_parens(self, node: ast.expr, op: ast.AST,
+                      left: ast.expr, right: ast.expr) -> bool:
         prec = precedence(type(op))
-        if (left.lineno != right.lineno and self.p_level == 0 and
+        if ((left.lineno != right.lineno and self.p_level == 0 and
                 (node.lineno, node.col_offset) >
-                (self.output_line, self.output_col)):
-            self.write('(')
-            self.precedence.append(-1)
-            p = True
-            self.p_level += 1
-        elif self.precedence[-1] > prec:
+                (self.output_line, self.output_col)) or
+                self.precedence[-1] > prec):
             self.write('(')
             self.precedence.append(-1)
-            p = True
             self.p_level += 1
-        else:
-            self.precedence.append(prec)
-            p = False
-        yield
+            return True
+        self.precedence.append(prec)
+        return False
+
+    def _exit_parens(self, p: bool) -> None:
         if p:
             self.write(')')
             self.p_level -= 1
         self.precedence.pop()
 
-    def visit_BinOp(self, node):
-        if self.make_fstring(node):
-            return
-        ops = {
-            ast.Mod: '%',
-            ast.Sub: '-',
-            ast.Add: '+',
-            ast.Mult: '*',
-            ast.Pow: '**',
-            ast.Div: '/',
-            ast.FloorDiv: '//',
-        }
-        with self.auto_parens(node, node.op, node.left, node.right):
-            self.visit(node.left)
-            self.write(' %s ' % (ops.get(type(node.op), str(node.op)),))
-            self.visit(node.right)
-
-    def visit_UnaryOp(self, node):
-        ops = {
-            ast.USub: '-',
-            ast.UAdd: '+',
-        }
-        self.print(ops.get(type(node.op), str(node.op)),
+    def visit_BinOp(self, node: ast.BinOp) -> None:
+        if type(node.op) is ast.Mod and isinstance(node.left, _STR_NODE):
+            if self.make_fstring(node):
+                return
+        p = self._enter_parens(node, node.op, node.left, node.right)
+        self.visit(node.left)
+        sym = _BINOP_PADDED.get(type(node.op))
+        self.write(sym if sym is not None else ' %s ' % (node.op,))
+        self.visit(node.right)
+        self._exit_parens(p)
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> None:
+        self.print(_UNARYOP_SYM.get(type(node.op), str(node.op)),
                    node.lineno, node.col_offset)
         self.visit(node.operand)
 
-    def visit_Compare(self, node):
+    def visit_Compare(self, node: ast.Compare) -> None:
         self.visit(node.left)
-        ops = {
-            ast.Lt: '<',
-            ast.Gt: '>',
-            ast.LtE: '<=',
-            ast.GtE: '>=',
-            ast.Eq: '==',
-            ast.NotEq: '!=',
-            ast.In: ' in ',
-            ast.Is: ' is ',
-            ast.IsNot: ' is not ',
-        }
         for op, right in zip(node.ops, node.comparators):
-            self.write(' %s ' % (ops.get(type(op), '?'),))
+            self.write(_CMPOP_PADDED.get(type(op), ' ? '))
             self.visit(right)
 
-    def visit_BoolOp(self, node):
-        ops = {
-            ast.And: ' and ',
-            ast.Or: ' or ',
-        }
-        with self.auto_parens(node, node.op, node.values[0], node.values[-1]):
-            for i, v in enumerate(node.values):
-                if i:
-                    self.write(ops[type(node.op)])
-                self.visit(v)
-
-    def visit_Lambda(self, node):
+    def visit_BoolOp(self, node: ast.BoolOp) -> None:
+        p = self._enter_parens(node, node.op, node.values[0], node.values[-1])
+        for i, v in enumerate(node.values):
+            if i:
+                self.write(_BOOLOP_SYM[type(node.op)])
+            self.visit(v)
+        self._exit_parens(p)
+
+    def visit_Lambda(self, node: ast.Lambda) -> None:
         self.print('lambda', node.lineno, node.col_offset)
         self.visit_arguments(node.args)
         self.write(':')
         self.visit(node.body)
 
     @staticmethod
-    def escape_string_part(s):
+    def escape_string_part(s: str) -> str:
+        if s.isprintable():
+            return s.translate(_ESCAPES)
         return repr('"' + s)[2:-1]
 
-    @contextlib.contextmanager
-    def capture_write(self, f):
-        l, c = self.output_line, self.output_col
-        old_write, self.write = self.write, f
-        old_print, self.print = self.print, (lambda s, l, c: self.write(s))
+    def _render_to_string(self, node: ast.AST) -> str:
+        save = self._buf
+        pool = self._buf_pool
+        buf = self._buf = pool.pop() if pool else []
         try:
-            yield
+            self.visit(node)
+            return ''.join(buf)
         finally:
-            self.write = old_write
-            self.print = old_print
-            self.output_line, self.output_col = l, c
-
-    def make_fstring(self, node):
-        if (isinstance(node, ast.BinOp) and
-                isinstance(node.op, ast.Mod) and
-                isinstance(node.left, ast.Str)):
-            if isinstance(node.right, ast.Tuple):
-                arguments = list(node.right.elts)
+            self._buf = save
+            buf.clear()
+            pool.append(buf)
+
+    def make_fstring(self, node: ast.BinOp) -> Optional[bool]:
+        s = _string_literal(node.left)
+        if s is None or '%' not in s:
+            return None
+        if isinstance(node.right, ast.Tuple):
+            arguments = node.right.elts
+        else:
+            arguments = [node.right]
+        parsed = _parse_format(s)
+        if parsed is None:
+            return None
+        res, n = parsed
+        if n != len(arguments):
+            return None
+        self.print('f\'', node.lineno, node.col_offset)
+        for part in res:
+            if isinstance(part, str):
+                part = self.escape_string_part(part).translate(_BRACES)
+                self.write(part)
             else:
-                arguments = [node.right]
-            pattern = (
-                r'%(?P<key>\([^)]*\))?' +
-                r'(?P<flag>[#0 +-]*)' +
-                r'(?P<widthprec>(?P<width>\*|\d+)?' +
-                r'(?:\.(?P<prec>\*|\d+))?)' +
-                r'(?P<length>[hlL])?' +
-                r'(?P<type>.)')
-            conversions = re.finditer(pattern, node.left.s)
-            res = []
-            i = 0
-            for mo in conversions:
-                j = mo.start(0)
-                res.append(node.left.s[i:j])
-                i = mo.end(0)
-                t = mo.group('type')
-                if t == '%':
-                    res.append('%')
-                elif t == 's':
-                    res.append((arguments.pop(0), ''))
-                elif t == 'r':
-                    res.append((arguments.pop(0), '!r'))
-                elif t in ('d', 'e', 'f', 'g'):
-                    res.append((arguments.pop(0),
-                                ':' + mo.group('widthprec') + t))
-                else:
-                    return
-            res.append(node.left.s[i:])
-            if arguments:
-                return
-            self.print('f\'', node.lineno, node.col_offset)
-            for part in res:
-                if isinstance(part, str):
-                    self.write(self.escape_string_part(part))
-                else:
-                    (a, t) = part
-                    self.write('{')
-                    a.lineno = self.output_line
-                    a.col_offset = self.output_col
-                    a_ = []
-                    with self.capture_write(a_.append):
-                        self.visit(a)
-                    self.write(self.escape_string_part(''.join(a_)))
-                    self.write(t)
-                    self.write('}')
-            self.write('\'')
-            return True
-
-    def visit_Attribute(self, node):
+                (k, t) = part
+                a = arguments[k]
+                self.write('{')
+                a.lineno = self.output_line
+                a.col_offset = self.output_col
+                self.write(self.escape_string_part(self._render_to_string(a)))
+                self.write(t)
+                self.write('}')
+        self.write('\'')
+        return True
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
         self.visit(node.value)
         self.write('.')
         self.write(node.attr)
 
-    def visit_Subscript(self, node):
+    def visit_Subscript(self, node: ast.Subscript) -> None:
         self.visit(node.value)
         self.write('[')
         self.visit(node.slice)
@@ -453,14 +653,14 @@ class Visitor(ast.NodeVisitor):
     def visit_Index(self, node):
         self.visit(node.value)
 
-    def visit_IfExp(self, node):
+    def visit_IfExp(self, node: ast.IfExp) -> None:
         self.visit(node.body)
         self.write(' if ')
         self.visit(node.test)
         self.write(' else ')
         self.visit(node.orelse)
 
-    def visit_Slice(self, node):
+    def visit_Slice(self, node: ast.Slice) -> None:
         if node.lower:
             self.visit(node.lower)
         self.write(':')
@@ -476,7 +676,7 @@ class Visitor(ast.NodeVisitor):
                 self.write(', ')
             self.visit(s)
 
-    def visit_Name(self, node):
+    def visit_Name(self, node: ast.Name) -> None:
         self.print(node.id, node.lineno, node.col_offset)
 
     def visit_NameConstant(self, node):
@@ -488,35 +688,40 @@ class Visitor(ast.NodeVisitor):
     def visit_Str(self, node):
         self.print(repr(node.s), node.lineno, node.col_offset)
 
-    def visit_JoinedStr(self, node):
+    def visit_Constant(self, node: ast.Constant) -> None:
+        self.print(repr(node.value), node.lineno, node.col_offset)
+
+    def visit_JoinedStr(self, node: ast.JoinedStr) -> None:
         self.print(repr(node.values), node.lineno, node.col_offset)
 
-    def visit_Tuple(self, node):
+    def visit_Tuple(self, node: ast.Tuple) -> None:
         if len(node.elts) > 0:
             self.print('(', node.lineno, node.col_offset - 1)
-            self.visit(node.elts[0])
-            for e in node.elts[1:]:
-                self.write(',')
-                self.visit(e)
+            self.visit_commasep(node.elts)
             if len(node.elts) == 1:
                 self.write(',')
             self.write(')')
         else:
             self.print('()', node.lineno, node.col_offset)
 
-    def visit_List(self, node):
+    def visit_List(self, node: ast.List) -> None:
         self.print('[', node.lineno, node.col_offset)
         self.visit_commasep(node.elts)
         self.write(']')
 
     def visit_Dict(self, node):
+        visit = self.visit
+        write = self.write
         self.print('{', node.lineno, node.col_offset)
         for k, v in zip(node.keys, node.values):
-            self.visit(k)
-            self.write(': ')
-            self.visit(v)
-            self.write(',')
-        self.write('}')
+            visit(k)
+            write(': ')
+            visit(v)
+            write(',')
+        write('}')
+
+
+Visitor._handlers = Visitor._build_handlers()
 
 
 def main():
@@ -532,10 +737,11 @@ def main():
     else:
         v.first_line = a
         v.last_line = b
-    v._source_lines = s.splitlines()
+    v._source = s
     v.visit(o)
     if v.output_col > 0:
         v.write('\n')
+    sys.stdout.write(v.getvalue())
 
 
 if __name__ == "__main__":
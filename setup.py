@@ -0,0 +1,16 @@
+from setuptools import setup
+
+try:
+    from mypyc.build import mypycify
+except ImportError:
+    # mypyc is optional; without it fstrings installs as plain Python.
+    ext_modules = []
+else:
+    ext_modules = mypycify(['fstrings.py'])
+
+
+setup(
+    name='fstrings',
+    py_modules=['fstrings'],
+    ext_modules=ext_modules,
+)